@@ -1,7 +1,18 @@
-import datetime
+import contextlib
+import hashlib
 import json
+import os
 import pathlib
+import numpy as np
 import pandas as pd
+import pyarrow.csv as pa_csv
+import pyarrow.feather as feather
+import pyarrow.parquet as pq
+
+AGE_GROUPS = ['0-4', '5-9', '10-19', '20-29', '30-39', '40-49', '50-59', '60-69', '70-79', '80+']
+MTL_AGE_COLS = ([f'cases_mtl_{age}_norm' for age in AGE_GROUPS]
+                + [f'cases_mtl_{age}_per100000_norm' for age in AGE_GROUPS])
+
 
 def reduce_cols(df, downsample):
     """Reduce number of columns in a pandas df by skipping alternate columns
@@ -18,16 +29,12 @@ def reduce_cols(df, downsample):
     pandas.core.frame.DataFrame
         A pandas dataframe with a reduced number of columns
     """
-    title_col = df.iloc[:, 0]  # always keep title col
-    last_col = df.iloc[:, -1]  # always keep data for latest day
-    cols_to_reduce = df.iloc[:, 1:-1]
-
-    ncols = cols_to_reduce.shape[1]
-    step = ncols // downsample
-    reduced_cols = cols_to_reduce.iloc[:, ::step]
-    new_cols = pd.concat([title_col, reduced_cols, last_col], axis=1)
+    ncols = df.shape[1]
+    step = max((ncols - 2) // downsample, 1)
+    # always keep title col and data for latest day
+    col_idx = np.r_[0, np.arange(1, ncols - 1, step), ncols - 1]
 
-    return new_cols
+    return df.take(col_idx, axis=1)
 
 
 def reduce_rows(df, downsample):
@@ -48,14 +55,249 @@ def reduce_rows(df, downsample):
         A pandas dataframe with a reduced number of rows
     """
     df = df[df['cases_mtl_0-4'].notna()]  # drop rows with no age data
-    last_row = df.iloc[-1, :]  # always keep data for latest day
-    rows_to_reduce = df.iloc[0:-1, :]
+    nrows = df.shape[0]
+    step = max((nrows - 1) // downsample, 1)
+    # always keep data for latest day
+    row_idx = np.r_[np.arange(0, nrows - 1, step), nrows - 1]
+
+    return df.take(row_idx, axis=0)
+
+
+@contextlib.contextmanager
+def atomic_write(path, mode='w', **kwargs):
+    """Open a file for writing through a temporary file, renamed to path once fully written
+
+    Other processes never read a partially written file, and path is left as it was if the write
+    fails (the temporary file is then removed).
+
+    Parameters
+    ----------
+    path : pathlib.Path or str
+        Path of the file to write.
+    mode : str, optional
+        Mode in which the file is opened, by default 'w'.
+    **kwargs
+        Other arguments passed to open() (e.g. encoding).
+
+    Yields
+    ------
+    file object
+        The temporary file, opened in the given mode.
+    """
+    tmp_path = '{}.tmp-{}'.format(path, os.getpid())
+    try:
+        with open(tmp_path, mode, **kwargs) as f:
+            yield f
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def file_digest(path):
+    """Return the BLAKE2b digest of the content of a file
+
+    Parameters
+    ----------
+    path : pathlib.Path
+        Path of the file.
+
+    Returns
+    -------
+    str
+        Hexadecimal digest of the file content.
+    """
+    with open(path, 'rb') as f:
+        return hashlib.blake2b(f.read(), digest_size=16).hexdigest()
+
+
+def load_data(csv_path, columns=None):
+    """Load a data file, reading its Parquet copy written by refreshdata.py if it is up to date
+
+    The Parquet copy is ignored if the csv file was modified since it was written (e.g. edited by
+    hand), which is checked with the digest of the csv file saved in the Parquet metadata.
+
+    Parameters
+    ----------
+    csv_path : pathlib.Path
+        Path of the csv data file.
+    columns : list of str, optional
+        Columns to load, by default None (all columns).
+
+    Returns
+    -------
+    pandas.core.frame.DataFrame
+        A pandas dataframe where the 'date' column (if any) has a datetime type
+    """
+    parquet_path = csv_path.with_suffix('.parquet')
+    if parquet_path.is_file():
+        metadata = pq.read_schema(str(parquet_path)).metadata or {}
+        if metadata.get(b'csv_digest') == file_digest(csv_path).encode():
+            return pq.read_table(parquet_path, columns=columns).to_pandas()
+
+    return read_csv_data(csv_path, columns)
+
+
+def read_csv_data(csv_path, columns=None, date_col='date'):
+    """Read a csv data file with pyarrow's multithreaded csv reader
+
+    Also used by refreshdata.py to write the Parquet copies, so that load_data gives the same data
+    whether it reads the csv file or its Parquet copy.
+
+    Parameters
+    ----------
+    csv_path : pathlib.Path or str
+        Path of the csv data file.
+    columns : list of str, optional
+        Columns to load, by default None (all columns).
+    date_col : str, optional
+        Name of the column (if present) to convert to a datetime type, by default 'date'.
+
+    Returns
+    -------
+    pandas.core.frame.DataFrame
+        A pandas dataframe
+    """
+    # 'na' is an additional null value in the data files
+    convert_options = pa_csv.ConvertOptions(include_columns=columns, strings_can_be_null=True,
+                                            null_values=pa_csv.ConvertOptions().null_values + ['na'])
+    df = pa_csv.read_csv(str(csv_path), convert_options=convert_options).to_pandas()
+    if date_col in df.columns:
+        df[date_col] = pd.to_datetime(df[date_col])
+    return df
+
+
+def build_state(data_path):
+    """Compute the data derived from the data files (tidy data for the figures and latest values)
+
+    Parameters
+    ----------
+    data_path : pathlib.Path
+        Path of the data folder.
+
+    Returns
+    -------
+    dict
+        Derived data in the format {name: value} where value is a pandas dataframe or a str
+    """
+    state = {}
+    data_mtl = load_data(data_path.joinpath('data_mtl.csv'),
+                         columns=['date', 'cases_mtl', 'deaths_mtl', 'cases_mtl_0-4'] + MTL_AGE_COLS)
+    data_qc = load_data(data_path.joinpath('processed', 'data_qc.csv'))
+
+    # Montreal cases per borough
+    cases_per1000_df = load_data(data_path.joinpath('processed', 'cases_per1000.csv')).dropna(axis=1, how='all')
+    state['cases_per1000_long'] = pd.melt(reduce_cols(cases_per1000_df, 10), id_vars='borough',
+                                          var_name='date', value_name='cases_per_1000')
+
+    # QC deaths by location data
+    data_qc_death_loc = load_data(data_path.joinpath('data_qc_death_loc.csv'))
+    data_qc_death_loc.columns = ['date', 'chsld', 'psr', 'home', 'other_or_unknown' ]
+    data_qc_death_loc['date'] = pd.to_datetime(data_qc_death_loc['date'])  # no-op when read from Parquet
+    state['data_qc_death_loc'] = data_qc_death_loc
+
+    # Last update date
+    # Display 1 day after the latest data as data from the previous day are posted
+    latest_mtl_date = data_mtl['date'].to_numpy()[-1] + np.timedelta64(1, 'D')
+    state['latest_update_date'] = str(latest_mtl_date.astype('datetime64[D]'))
+
+    # Mini info boxes
+    # (last non-null value of each column)
+    latest_mtl = data_mtl[['cases_mtl', 'deaths_mtl']].ffill().iloc[-1]
+    state['latest_cases_mtl'] = str(int(latest_mtl['cases_mtl']))
+    state['latest_deaths_mtl'] = str(int(latest_mtl['deaths_mtl']))
+
+    latest_qc = data_qc[['cases_qc', 'deaths_qc', 'hospitalisations_qc', 'icu_qc', 'negative_tests_qc']].ffill().iloc[-1]
+    state['latest_cases_qc'] = str(int(latest_qc['cases_qc']))
+    state['latest_deaths_qc'] = str(int(latest_qc['deaths_qc']))
+    state['latest_hospitalisations_qc'] = str(int(latest_qc['hospitalisations_qc']))
+    state['latest_icu_qc'] = str(int(latest_qc['icu_qc']))
+    state['latest_negative_tests_qc'] = str(int(latest_qc['negative_tests_qc']))
+
+    data_qc_recovered = load_data(data_path.joinpath('data_qc_recovered.csv'))
+    state['latest_recovered_qc'] = str(int(data_qc_recovered['recovered_qc'].ffill().iloc[-1]))
+
+    # Make MTL histogram data tidy
+    # (same as melting the age group columns then dropping NaNs, without the intermediate frames)
+    mtl_age_wide = reduce_rows(data_mtl, 10)
+    percent = mtl_age_wide[MTL_AGE_COLS].to_numpy(dtype=float).ravel(order='F')
+    dates = mtl_age_wide['date'].dt.strftime('%Y-%m-%d').to_numpy()  # animation frame labels
+    has_data = ~np.isnan(percent)
+    state['mtl_age_data'] = pd.DataFrame({
+        'date': np.tile(dates, len(MTL_AGE_COLS))[has_data],
+        'age_group': np.repeat(MTL_AGE_COLS, len(mtl_age_wide))[has_data],
+        'percent': percent[has_data]
+    })
+
+    return state
+
+
+def save_state(state_path, state, data_files):
+    """Save derived data: dataframes as Arrow IPC (feather) files and other values in state.json
+
+    Parameters
+    ----------
+    state_path : pathlib.Path
+        Path of the folder in which to save the derived data.
+    state : dict
+        Derived data as returned by build_state.
+    data_files : list of pathlib.Path
+        Files from which the derived data is computed, their digests are saved in state.json.
+
+    Raises
+    ------
+    OSError
+        The derived data could not be saved (e.g. read-only data folder).
+    """
+    state_path.mkdir(exist_ok=True)
+    values = {'dataframes': [], 'digests': [file_digest(f) for f in data_files]}
+    for name, value in state.items():
+        if isinstance(value, pd.DataFrame):
+            with atomic_write(state_path.joinpath(name + '.feather'), 'wb') as f:
+                feather.write_feather(value.reset_index(drop=True), f)
+            values['dataframes'].append(name)
+        else:
+            values[name] = value
+
+    # written last so that it only lists complete feather files
+    with atomic_write(state_path.joinpath('state.json'), encoding='utf-8') as f:
+        json.dump(values, f)
 
-    nrows = rows_to_reduce.shape[0]
-    step = nrows // downsample
-    reduced_rows = rows_to_reduce.iloc[::step, :]
-    new_rows = reduced_rows.append(last_row)
-    return new_rows
+
+def load_state(state_path, data_files):
+    """Load derived data saved by save_state if it was computed from the current data files
+
+    The digests of the data files are compared with the ones saved in state.json, as modification
+    times are not kept by git. core.py should be part of data_files so that the derived data is
+    recomputed when the code changes.
+
+    Parameters
+    ----------
+    state_path : pathlib.Path
+        Path of the folder containing the derived data.
+    data_files : list of pathlib.Path
+        Files from which the derived data is computed.
+
+    Returns
+    -------
+    dict or None
+        Derived data in the format {name: value}, None if it is missing, incomplete or out of date.
+    """
+    state_json = state_path.joinpath('state.json')
+    if not state_json.is_file():
+        return None
+
+    with open(state_json, encoding='utf-8') as f:
+        state = json.load(f)
+    if state.pop('digests', None) != [file_digest(f) for f in data_files]:
+        return None
+    feather_paths = {name: state_path.joinpath(name + '.feather') for name in state.pop('dataframes')}
+    if not all(path.is_file() for path in feather_paths.values()):
+        return None
+    for name, path in feather_paths.items():
+        state[name] = feather.read_table(str(path)).to_pandas()
+    return state
 
 
 # get relative data folder
@@ -67,55 +309,48 @@ DATA_PATH = PATH.joinpath('data').resolve()
 with open(DATA_PATH.joinpath('montreal_shapefile.geojson'), encoding='utf-8') as shapefile:
     mtl_geojson = json.load(shapefile)
 
-# Montreal cases per borough
-cases_per1000_csv = DATA_PATH.joinpath('processed', 'cases_per1000.csv')
-cases_per1000_df = pd.read_csv(cases_per1000_csv, encoding='utf-8', na_values='na').dropna(axis=1, how='all')
-cases_per1000_long = pd.melt(reduce_cols(cases_per1000_df, 10), id_vars='borough',
-                             var_name='date', value_name='cases_per_1000')
-
 # Montreal data
-data_mtl = pd.read_csv(DATA_PATH.joinpath('data_mtl.csv'), encoding='utf-8', na_values='na')
+# (the age group columns are only needed by build_state, which loads them itself)
+data_mtl = load_data(DATA_PATH.joinpath('data_mtl.csv'),
+                     columns=['date', 'cases_mtl', 'new_cases_mtl', 'deaths_mtl', 'new_deaths_mtl'])
 
 # QC data
-data_qc = pd.read_csv(DATA_PATH.joinpath('processed', 'data_qc.csv'), encoding='utf-8', na_values='na')
-data_qc_recovered = pd.read_csv(DATA_PATH.joinpath('data_qc_recovered.csv'), encoding='utf-8', na_values='na')
+data_qc = load_data(DATA_PATH.joinpath('processed', 'data_qc.csv'))
 
 # MTL deaths by location data
-data_mtl_death_loc = pd.read_csv(DATA_PATH.joinpath('processed', 'data_mtl_death_loc.csv'),
-                                encoding='utf-8', na_values='na')
+data_mtl_death_loc = load_data(DATA_PATH.joinpath('processed', 'data_mtl_death_loc.csv'))
+
+##### derived data #####
+# Saved in data/state by refreshdata.py, only recomputed here when one of the data files or this
+# module changed since (e.g. data file edited by hand)
+STATE_PATH = DATA_PATH.joinpath('state')
+STATE_DATA_FILES = [pathlib.Path(__file__)] + [
+    DATA_PATH.joinpath(data_file) for data_file in ['data_mtl.csv', 'data_qc_recovered.csv', 'data_qc_death_loc.csv',
+                                                    'processed/cases_per1000.csv', 'processed/data_qc.csv']]
+
+state = load_state(STATE_PATH, STATE_DATA_FILES)
+if state is None:
+    state = build_state(DATA_PATH)
+    try:
+        save_state(STATE_PATH, state, STATE_DATA_FILES)
+    except OSError:
+        pass  # e.g. read-only data folder, use the derived data without saving it
 
-# QC deaths by location data
-data_qc_death_loc = pd.read_csv(DATA_PATH.joinpath('data_qc_death_loc.csv'),
-                                encoding='utf-8', na_values='na')
-data_qc_death_loc.columns = ['date', 'chsld', 'psr', 'home', 'other_or_unknown' ]
-data_qc_death_loc['date'] = pd.to_datetime(data_qc_death_loc['date'])  # convert date str to datetime
+cases_per1000_long = state['cases_per1000_long']
+mtl_age_data = state['mtl_age_data']
+data_qc_death_loc = state['data_qc_death_loc']
 
 # Last update date
-# Display 1 day after the latest data as data from the previous day are posted
-latest_mtl_date = datetime.date.fromisoformat(data_mtl['date'].iloc[-1]) + datetime.timedelta(days=1)
-latest_update_date = latest_mtl_date.isoformat()
+latest_update_date = state['latest_update_date']
 
 # Mini info boxes
-latest_cases_mtl = str(int(data_mtl['cases_mtl'].dropna().iloc[-1]))
-latest_deaths_mtl = str(int(data_mtl['deaths_mtl'].dropna().iloc[-1]))
-
-latest_cases_qc = str(int(data_qc['cases_qc'].dropna().iloc[-1]))
-latest_deaths_qc = str(int(data_qc['deaths_qc'].dropna().iloc[-1]))
-latest_hospitalisations_qc = str(int(data_qc['hospitalisations_qc'].dropna().iloc[-1]))
-latest_icu_qc = str(int(data_qc['icu_qc'].dropna().iloc[-1]))
-latest_negative_tests_qc = str(int(data_qc['negative_tests_qc'].dropna().iloc[-1]))
-
-latest_recovered_qc = str(int(data_qc_recovered['recovered_qc'].dropna().iloc[-1]))
-
-# Make MTL histogram data tidy
-mtl_age_data = reduce_rows(data_mtl, 10).melt(id_vars='date', value_vars=['cases_mtl_0-4_norm', 'cases_mtl_5-9_norm',
-                                               'cases_mtl_10-19_norm', 'cases_mtl_20-29_norm',
-                                               'cases_mtl_30-39_norm', 'cases_mtl_40-49_norm',
-                                               'cases_mtl_50-59_norm', 'cases_mtl_60-69_norm',
-                                               'cases_mtl_70-79_norm', 'cases_mtl_80+_norm',
-                                          'cases_mtl_0-4_per100000_norm', 'cases_mtl_5-9_per100000_norm',
-                                               'cases_mtl_10-19_per100000_norm', 'cases_mtl_20-29_per100000_norm',
-                                               'cases_mtl_30-39_per100000_norm', 'cases_mtl_40-49_per100000_norm',
-                                               'cases_mtl_50-59_per100000_norm', 'cases_mtl_60-69_per100000_norm',
-                                               'cases_mtl_70-79_per100000_norm', 'cases_mtl_80+_per100000_norm'
-                                              ],var_name='age_group', value_name='percent').dropna()
+latest_cases_mtl = state['latest_cases_mtl']
+latest_deaths_mtl = state['latest_deaths_mtl']
+
+latest_cases_qc = state['latest_cases_qc']
+latest_deaths_qc = state['latest_deaths_qc']
+latest_hospitalisations_qc = state['latest_hospitalisations_qc']
+latest_icu_qc = state['latest_icu_qc']
+latest_negative_tests_qc = state['latest_negative_tests_qc']
+
+latest_recovered_qc = state['latest_recovered_qc']
@@ -4,7 +4,7 @@
 import os
 import shutil
 import sys
-#import fcntl
+import time
 import csv
 import logging
 import re
@@ -12,6 +12,8 @@ import io
 
 from datetime import date, datetime, timedelta
 from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 from charset_normalizer import CharsetNormalizerMatches as cnm
 
 import requests
@@ -19,11 +21,19 @@ import lxml
 import bs4
 import pytz
 import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+try:
+    import fcntl
+except ImportError:  # not available on Windows
+    fcntl = None
+
+import core  # app/core.py, found as this script's folder is on sys.path
 pd.options.mode.chained_assignment = None
 
 DATA_DIR = os.path.join(os.path.dirname(__file__), 'data')
 NB_RETRIES = 3
-# CHARSET_PAT = re.compile(r'charset=((\w|-)+)')
+CHARSET_PAT = re.compile(r'charset=((\w|-)+)')
 # NUM_PAT = re.compile(r'\*?((?:\d| |,)+)')
 TIMEZONE = pytz.timezone('America/Montreal')
 
@@ -75,22 +85,38 @@ SOURCES = {
     }
 
 
-# def lock(lock_dir):
-#     ''' Lock the data directory to prenvent concurent runs of the scraper, 
-#     which would be risky for data corruption. '''
+# Data files loaded by the app which get a Parquet copy after each refresh
+# {path relative to DATA_DIR: name of the date column (None if no date column)}
+PARQUET_FILES = {
+    'data_mtl.csv': 'date',
+    'data_qc_recovered.csv': 'date',
+    'data_qc_death_loc.csv': 'Date de décès',
+    os.path.join('processed', 'cases_per1000.csv'): None,
+    os.path.join('processed', 'data_qc.csv'): 'date',
+    os.path.join('processed', 'data_mtl_death_loc.csv'): 'date',
+    }
+
 
-#     lockf = os.path.join(lock_dir, 'scraper.pid')
-#     if not os.path.isfile(lockf):
-#         logging.debug('Lock file {} not present.  Creating.'.format(lockf))
-#         # create the file, empty
-#         open(lockf, 'w').close()
-#     logging.debug('Acquiring lock: {}'.format(lockf))
-#     fd = os.open(lockf, os.O_RDONLY)
-#     fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+def lock(lock_dir):
+    ''' Lock the data directory to prenvent concurent runs of the scraper, 
+    which would be risky for data corruption. 
+    Exit right away if another run holds the lock.  Does nothing on Windows. '''
+    if fcntl is None:
+        return
 
-#     # No unlocking needed.  fcntl() locks are released then the process exits.
-#     with open(lockf, 'w') as f:
-#         f.write('{}'.format(os.getpid))
+    lockf = os.path.join(lock_dir, 'scraper.pid')
+    logging.debug('Acquiring lock: {}'.format(lockf))
+    fd = os.open(lockf, os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        pid = os.read(fd, 32).decode() or 'unknown'
+        os.close(fd)
+        sys.exit('refreshdata is already running (pid {})'.format(pid))
+
+    # No unlocking needed.  fcntl() locks are released then the process exits.
+    os.ftruncate(fd, 0)
+    os.write(fd, str(os.getpid()).encode())
 
 
 # def normalize_encoding(data, content_type=None):
@@ -131,16 +157,27 @@ def normalise_to_utf8(bytes_or_filepath):
     return utf8_str
 
 
-def fetch(url):
-    ''' Get the data at `url`.  Our data sources are notoriously unreliable, 
-    so we retry a few times. '''
-    for _ in range(NB_RETRIES):
-        resp = requests.get(url)
-        if resp.status_code != 200:
-            next
-        # ctype = resp.headers.get('Content-Type')
-        # return normalize_encoding(resp.content, ctype)
-        return normalise_to_utf8(resp.content)
+def fetch_to(url, filename, session=requests):
+    ''' Save the data at `url` to `filename` in UTF-8.  Our data sources are 
+    notoriously unreliable, so we retry a few times, waiting longer each time. 
+    Pass a requests.Session as `session` to reuse its connections. '''
+    for i in range(NB_RETRIES):
+        if i:
+            time.sleep(2 ** i)
+        try:
+            with session.get(url, stream=True, timeout=30) as resp:
+                if resp.status_code != 200:
+                    logging.warning('Got HTTP {} for {}'.format(resp.status_code, url))
+                    continue
+                match = CHARSET_PAT.search(resp.headers.get('Content-Type', ''))
+                if match and match.group(1).lower() in ('utf-8', 'utf8'):
+                    # already UTF-8, write it to disk as it is received
+                    save_datafile(filename, resp.iter_content(chunk_size=64 << 10), True)
+                else:
+                    save_datafile(filename, [normalise_to_utf8(resp.content).encode('utf-8')], True)
+                return
+        except requests.RequestException as e:
+            logging.warning('Failed to retrieve {}: {}'.format(url, e))
     raise RuntimeError('Failed to retrieve {}'.format(url))
 
 
@@ -158,6 +195,7 @@ def save_datafile(filename, data, strict=False):
     ''' Save a datafile if it's newer and at least as big as what we cached.  
     Raise ValueError otherwise.
 
+    `data` is an iterable of UTF-8 encoded chunks of bytes, written as they come.
     If strict=False, sanity tests are bypassed and retrieved data is always 
     saved.'''
     # if os.path.isfile(filename):
@@ -171,8 +209,10 @@ def save_datafile(filename, data, strict=False):
     #         raise ValueError(msg)
     #     backup(filename)
     # it's all good if we made it this far, save the new file 
-    with open(filename, 'w', encoding='utf-8') as f:
-        f.write(data)
+    # (through a temporary file so an interrupted write never leaves a truncated file)
+    with core.atomic_write(filename, 'wb') as f:
+        for chunk in data:
+            f.write(chunk)
     logging.info('Saved a new version of {}'.format(filename))
 
 
@@ -281,6 +321,9 @@ def save_datafile(filename, data, strict=False):
 def backup_processed_dir(processed_dir, processed_backups_dir):
     """Copy all files from data/processed to data/processed_backups/YYYY-MM-DD{_v#}
 
+    Parquet copies are not backed up as they are written from the csv files. No backup is made
+    if the files are the same as in the latest backup.
+
      Parameters
     ----------
     processed_dir : dict
@@ -288,6 +331,17 @@ def backup_processed_dir(processed_dir, processed_backups_dir):
     processed_backups_dir : str
         Absolute path of dir in which to save the backup.
     """
+    files = [file for file in os.listdir(processed_dir) if not file.endswith('.parquet')]
+
+    # skip the backup if no file changed since the latest backup
+    if os.listdir(processed_backups_dir):
+        latest_bkp_dir = os.path.join(processed_backups_dir, get_latest_source_dir(processed_backups_dir))
+        bkp_paths = [os.path.join(latest_bkp_dir, file) for file in files]
+        if all(os.path.isfile(bkp_path) and core.file_digest(os.path.join(processed_dir, file)) == core.file_digest(bkp_path)
+               for file, bkp_path in zip(files, bkp_paths)):
+            print(f'{processed_dir} is unchanged since its backup in {latest_bkp_dir}')
+            return
+
     date_tag = datetime.now(tz=TIMEZONE).date().isoformat()
 
     # make backup dir
@@ -301,7 +355,7 @@ def backup_processed_dir(processed_dir, processed_backups_dir):
         os.mkdir(current_bkp_dir)
 
     # Copy all files from data/processed to data/processed_backups/YYYY-MM-DD{_v#}
-    for file in os.listdir(processed_dir):
+    for file in files:
         file_path = os.path.join(processed_dir, file)
         shutil.copy(file_path, current_bkp_dir)
 
@@ -333,10 +387,11 @@ def download_source_files(sources, sources_dir):
         os.mkdir(current_sources_dir)
 
     # Download all source data files to sources dir
-    for file, url in sources.items():
-        data = fetch(url)
-        fq_path = os.path.join(current_sources_dir, file)
-        save_datafile(fq_path, data, True)
+    # Downloads are network bound, so they are done concurrently
+    with requests.Session() as session, ThreadPoolExecutor(max_workers=len(sources)) as executor:
+        fq_paths = [os.path.join(current_sources_dir, file) for file in sources]
+        # consume the results to raise any download error
+        list(executor.map(partial(fetch_to, session=session), sources.values(), fq_paths))
 
 
 def get_latest_source_dir(sources_dir):
@@ -497,6 +552,29 @@ def append_mtl_death_loc_csv(sources_dir, processed_dir, date):
     return mtl_death_loc_df
 
 
+def write_parquet(csv_path, date_col=None):
+    """Write a Parquet copy of a csv data file next to it (e.g. data_qc.csv -> data_qc.parquet).
+
+    The csv file is read with app/core.py's read_csv_data, as in load_data, so the app gets the
+    same data whether it loads the csv file or its Parquet copy.
+
+    Parameters
+    ----------
+    csv_path : str
+        Absolute path of the csv file to convert.
+    date_col : str, optional
+        Name of the column to store as a typed timestamp column, by default None.
+    """
+    df = core.read_csv_data(csv_path, date_col=date_col)
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    # load_data only reads the Parquet copy while the csv file still has this digest
+    metadata = {**table.schema.metadata, b'csv_digest': core.file_digest(csv_path).encode()}
+    table = table.replace_schema_metadata(metadata)
+    parquet_path = os.path.splitext(csv_path)[0] + '.parquet'
+    with core.atomic_write(parquet_path, 'wb') as f:
+        pq.write_table(table, f, compression='zstd')
+
+
 def main():
     parser = ArgumentParser('refreshdata', description=__doc__)
     parser.add_argument('-nd', '--no-download', action='store_true', default=False, 
@@ -514,7 +592,7 @@ def main():
     #                     help='By pass sanity checks')
     args = parser.parse_args()
     # init_logging(args)
-    #lock(args.data_dir)
+    lock(DATA_DIR)
 
     # Yesterday's date (data is reported for previous day)
     yesterday_date = datetime.now(tz=TIMEZONE) - timedelta(days=1)
@@ -550,6 +628,13 @@ def main():
     
     # Append row to data_mtl.csv
 
+    # Write Parquet copies of the data files loaded by the app
+    for file, date_col in PARQUET_FILES.items():
+        write_parquet(os.path.join(DATA_DIR, file), date_col)
+
+    # Save the data derived by the app from the data files (see app/core.py)
+    core.save_state(core.STATE_PATH, core.build_state(core.DATA_PATH), core.STATE_DATA_FILES)
+
     return 0
 
 